@@ -1,16 +1,35 @@
+import asyncio
+import io
 import os
 import re
 import signal
-import sys
+import time
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
-from database import get_daily_user_stats, init_db, save_voice_session, get_activity
-from graphs import create_activity_per_day_graph, create_grouped_bar_chart, create_daily_activity
+from database import (
+    close_db,
+    flush_voice_sessions,
+    get_activity,
+    get_all_users_daily_stats,
+    get_daily_user_stats,
+    get_user_sessions_token,
+    init_db,
+    optimize_db,
+    pending_voice_sessions,
+    queue_voice_session,
+)
+from graphs import (
+    create_activity_per_day_graph,
+    create_activity_per_day_graph_pil,
+    create_daily_activity,
+    create_grouped_bar_chart,
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -18,6 +37,11 @@ load_dotenv()
 # --- Configuration ---
 TOKEN = os.getenv("DISCORD_TOKEN")
 MIN_TIME_TRACK = 2  # in seconds
+FLUSH_INTERVAL = 2  # in seconds
+FLUSH_BATCH_SIZE = 50  # flush early once this many sessions are queued
+OPTIMIZE_INTERVAL = 6  # in hours, refresh the sqlite planner statistics
+# "pillow" draws !stats directly with Pillow, "matplotlib" keeps the old renderer
+GRAPH_RENDERER = os.getenv("GRAPH_RENDERER", "matplotlib")
 
 # --- Database Setup ---
 init_db()
@@ -32,24 +56,28 @@ intents.guilds = True
 
 bot = commands.Bot(command_prefix="!", intents=intents)
 
-# Dictionary to temporarily store join times: {user_id: start_time}
+# Dictionary to temporarily store open sessions: {user_id: UserVoiceEvent}
 active_users = {}
+# Early flushes started by log_user, the loop only keeps weak references
+flush_tasks = set()
 init_time: datetime
 
 
-@dataclass
+# slots drop the per-instance __dict__, there is one of these per user in voice
+@dataclass(slots=True)
 class UserVoiceEvent:
     user_id: int
     user_name: str
     channel_id: int
     channel_name: str
-    timestamp: datetime
+    timestamp: float  # unix time the session started
 
 
-def flush():
+def queue_active_sessions():
+    """Queues the open sessions up to now, they keep being tracked from there."""
+    end_time = time.time()
     for event in active_users.values():
-        end_time = datetime.now()
-        save_voice_session(
+        queue_voice_session(
             event.user_id,
             event.user_name,
             event.channel_id,
@@ -57,9 +85,17 @@ def flush():
             event.timestamp,
             end_time,
         )
+        # the time up to now is queued, the session continues from here
+        event.timestamp = end_time
         print(f"Tracked user {event.user_name} in {event.channel_name}")
 
 
+def flush():
+    queue_active_sessions()
+    # everything queued so far goes out in a single transaction
+    flush_voice_sessions()
+
+
 def load_users():
     # 1. Loop through every Guild (Server) the bot is in
     for guild in bot.guilds:
@@ -73,19 +109,19 @@ def load_users():
                     user_name=member.name,
                     channel_id=channel.id,
                     channel_name=channel.name,
-                    timestamp=datetime.now(),
+                    timestamp=time.time(),
                 )
 
-def clean_exit(signum, frame):
-    flush()
-    sys.exit(0)
-
-
-# register_signals logic
-# SIGINT = Ctrl+C
-# SIGTERM = Docker stop / System kill
-signal.signal(signal.SIGINT, clean_exit)
-signal.signal(signal.SIGTERM, clean_exit)
+@bot.event
+async def setup_hook():
+    # register_signals logic
+    # SIGINT = Ctrl+C
+    # SIGTERM = Docker stop / System kill
+    # Handled on the event loop instead of interrupting whatever code holds
+    # the queue lock, bot.run then returns and __main__ saves the sessions
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: asyncio.create_task(bot.close()))
 
 
 @bot.event
@@ -94,6 +130,34 @@ async def on_ready():
     print(f"Logged in as {bot.user.name}")
     init_time = datetime.now()
     load_users()
+    if not flush_sessions.is_running():
+        flush_sessions.start()
+    if not optimize_database.is_running():
+        optimize_database.start()
+
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_sessions():
+    """Periodically writes queued voice sessions to the database."""
+    # Quiet servers have nothing queued most of the time, skip the thread hop
+    if not pending_voice_sessions():
+        return
+    # sqlite blocks on disk I/O, keep it off the event loop
+    try:
+        await asyncio.to_thread(flush_voice_sessions)
+    except Exception as error:
+        # an unhandled error would stop the loop for good, the sessions are
+        # still queued and retried on the next iteration
+        print(f"Failed to flush voice sessions: {error}")
+
+
+@tasks.loop(hours=OPTIMIZE_INTERVAL)
+async def optimize_database():
+    """Periodically refreshes the sqlite planner statistics."""
+    try:
+        await asyncio.to_thread(optimize_db)
+    except Exception as error:
+        print(f"Failed to optimize the database: {error}")
 
 
 @bot.event
@@ -106,7 +170,7 @@ async def on_voice_state_update(member, before, after):
     if member.bot:
         return
 
-    event_time = datetime.now()
+    event_time = time.time()
 
     # CASE 1: User Joined a Channel (before is None, after is a channel)
     # OR User moved from one channel to another (we treat move as leave old + join new)
@@ -135,12 +199,12 @@ async def log_user(user: UserVoiceEvent):
     """
     Finalizes a voice session and saves it to the database.
     """
-    end_time = datetime.now()
+    end_time = time.time()
     duration = end_time - user.timestamp
 
-    # Only log sessions that lasted longer than 5 seconds
-    if duration > timedelta(seconds=MIN_TIME_TRACK):
-        save_voice_session(
+    # Only log sessions that lasted longer than MIN_TIME_TRACK seconds
+    if duration > MIN_TIME_TRACK:
+        pending = queue_voice_session(
             user_id=user.user_id,
             user_name=user.user_name,
             channel_id=user.channel_id,
@@ -148,7 +212,15 @@ async def log_user(user: UserVoiceEvent):
             start_time=user.timestamp,
             end_time=end_time,
         )
-        print(f"Logged {user.user_name} for {duration} in {user.channel_name}")
+        if pending >= FLUSH_BATCH_SIZE:
+            # Scheduled rather than awaited, a move still has to store the
+            # member's new session before any other event runs
+            task = asyncio.create_task(flush_sessions())
+            flush_tasks.add(task)
+            task.add_done_callback(flush_tasks.discard)
+        print(
+            f"Logged {user.user_name} for {timedelta(seconds=round(duration))} in {user.channel_name}"
+        )
     else:
         print(f"Active time for {user.user_name} is less than {MIN_TIME_TRACK}s")
 
@@ -157,8 +229,11 @@ async def log_user(user: UserVoiceEvent):
 @bot.command()
 async def reload(ctx):
     print("reload is called")
-    flush()
+    # Nothing awaits until the sessions are queued and reloaded, so voice
+    # events can't interleave and get counted twice
+    queue_active_sessions()
     load_users()
+    await asyncio.to_thread(flush_voice_sessions)
     await ctx.send("State flushed to db.")
 
 
@@ -178,21 +253,31 @@ async def weekly(ctx):
         (now + timedelta(days=6 - now.weekday())).date(), datetime.max.time()
     )
 
-    user_activity = {}
-    days = None
-    for user in ctx.guild.members:
-        if not user.bot:
-            dates, values = zip(
-                *list(get_daily_user_stats(user.id, form_date, to_date))
-            )
-            user_activity[user.display_name] = [
-                v.total_seconds() / 3600 for v in values
-            ]
-            if not days:
-                days = (day.strftime("%a\n%m/%d") for day in dates)
+    # One query for the whole server, joined with the member list below
+    daily_stats = await asyncio.to_thread(
+        get_all_users_daily_stats, form_date, to_date
+    )
+    days = [
+        (form_date + timedelta(days=i)).strftime("%a\n%m/%d")
+        for i in range((to_date - form_date).days + 1)
+    ]
+
+    # hours per day for every active user, silent members share one zero row
+    hours = {
+        user_id: [v.total_seconds() / 3600 for _, v in stats]
+        for user_id, stats in daily_stats.items()
+    }
+    no_activity = [0.0] * len(days)
+    user_activity = {
+        user.display_name: hours.get(user.id, no_activity)
+        for user in ctx.guild.members
+        if not user.bot
+    }
 
     # Create the graph
-    graph_buffer = create_grouped_bar_chart(days, user_activity)
+    graph_buffer = await asyncio.to_thread(
+        create_grouped_bar_chart, days, user_activity
+    )
 
     if graph_buffer:
         file = discord.File(graph_buffer, filename="week_stats.png")
@@ -219,36 +304,64 @@ async def stats(ctx, target_user: discord.Member | None = None):
         return
 
     # Get data for the specified number of days
-    form_date = datetime.combine(
-        datetime.now().date() - timedelta(days=days), datetime.min.time()
+    # (read the clock once so both ends agree even around midnight)
+    today = datetime.now().date()
+    form_date = datetime.combine(today - timedelta(days=days), datetime.min.time())
+    to_date = datetime.combine(today, datetime.max.time())
+    cache_token = await asyncio.to_thread(
+        get_user_sessions_token, target_user.id, form_date, to_date
+    )
+    png, total = await asyncio.to_thread(
+        render_user_stats, target_user.id, form_date, to_date, cache_token
     )
-    to_date = datetime.combine(datetime.now().date(), datetime.max.time())
-    daily_data = get_daily_user_stats(target_user.id, form_date, to_date)
-
-    # Calculate total time
-    total = timedelta(seconds=0)
-    for _, time_delta in daily_data:
-        total += time_delta
 
-    if total.seconds == 0:
+    if not total:
         await ctx.send(
             f"No voice activity recorded for {target_user.display_name} in last {days} days."
         )
         return
 
-    # Create the graph
-    graph_buffer = create_activity_per_day_graph(daily_data)
-
-    if graph_buffer:
-        file = discord.File(graph_buffer, filename="stats.png")
+    # timedelta.seconds drops whole days, use the full amount
+    total_seconds = int(total.total_seconds())
+    if png:
+        # BytesIO is consumed by the upload, wrap the cached bytes every time
+        file = discord.File(io.BytesIO(png), filename="stats.png")
         await ctx.send(
-            f"**{target_user.display_name}** was active for **{total.seconds // 3600}h {(total.seconds % 3600) // 60}m** in last **{days}** days.",
+            f"**{target_user.display_name}** was active for **{total_seconds // 3600}h {(total_seconds % 3600) // 60}m** in last **{days}** days.",
             file=file,
         )
     else:
         await ctx.send("Failed to generate graph.")
 
 
+@lru_cache(maxsize=128)
+def render_user_stats(user_id, from_date, to_date, cache_token):
+    """
+    Builds the daily activity graph of a user.
+    Results are cached, cache_token has to change whenever the user's
+    time in the range changes (see get_user_sessions_token).
+
+    Returns:
+        (PNG bytes or None, total active time)
+    """
+    daily_data = get_daily_user_stats(user_id, from_date, to_date)
+
+    # Calculate total time
+    total = timedelta(seconds=0)
+    for _, time_delta in daily_data:
+        total += time_delta
+
+    if not total:
+        return None, total
+
+    # Create the graph
+    if GRAPH_RENDERER == "pillow":
+        graph_buffer = create_activity_per_day_graph_pil(daily_data)
+    else:
+        graph_buffer = create_activity_per_day_graph(daily_data)
+    return (graph_buffer.getvalue() if graph_buffer else None), total
+
+
 @bot.command()
 async def ping(ctx):
     """
@@ -290,9 +403,9 @@ async def activity(ctx, *, when:str = ""):
     # Get data for the specified number of days
     form_date = datetime.combine(date, datetime.min.time())
     to_date = datetime.combine(date, datetime.max.time())
-    data = get_activity(form_date, to_date)
+    data = await asyncio.to_thread(get_activity, form_date, to_date)
     if data:
-        graph_buffer = create_daily_activity(data)
+        graph_buffer = await asyncio.to_thread(create_daily_activity, data)
         file = discord.File(graph_buffer, filename="stats.png")
         await ctx.send(
             f"Server activity for {date}:",
@@ -306,3 +419,7 @@ async def activity(ctx, *, when:str = ""):
 
 if __name__ == "__main__":
     bot.run(TOKEN)
+    # bot.run returns once the bot is closed, save the sessions that are
+    # still open and release the shared connection
+    flush()
+    close_db()
@@ -1,16 +1,55 @@
+import os
 import sqlite3
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+import numpy as np
+
+# Default location, overridden by the DATABASE_PATH environment variable
 DB_NAME = "./data/stats.db"
 
+# Long-lived connection shared by every query, opened once in init_db()
+_conn: sqlite3.Connection | None = None
+# The connection is shared between the event loop and worker threads
+_lock = threading.Lock()
+
+# Finished sessions waiting to be written by flush_voice_sessions()
+_pending: list[tuple] = []
+_pending_lock = threading.Lock()
+
+_INSERT_SESSION_SQL = """
+    INSERT INTO voice_sessions (
+        user_id, user_name, channel_id, channel_name, start_time, end_time
+    ) VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+_ADD_DAILY_TOTAL_SQL = """
+    INSERT INTO daily_totals (user_id, day, seconds) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, day) DO UPDATE SET seconds = seconds + excluded.seconds
+"""
+
 
 def init_db():
-    """Initializes the SQLite database."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    """Initializes the SQLite database and opens the shared connection."""
+    global _conn
+    # read at call time so a .env loaded after import is honoured
+    path = os.getenv("DATABASE_PATH", DB_NAME)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Writes open their transaction with BEGIN IMMEDIATE, taking the write
+    # lock up front so busy_timeout applies instead of failing on upgrade
+    _conn = sqlite3.connect(
+        path, check_same_thread=False, isolation_level="IMMEDIATE"
+    )
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.execute("PRAGMA temp_store=MEMORY")
+    _conn.execute("PRAGMA cache_size=-64000")
+    _conn.execute("PRAGMA busy_timeout=5000")
     # start_time and end_time are unix timestamps
-    c.execute("""
+    with _lock, _conn:
+        _conn.execute("""
         CREATE TABLE IF NOT EXISTS voice_sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -21,8 +60,52 @@ def init_db():
             end_time INTEGER
         )
     """)
-    conn.commit()
-    conn.close()
+        # get_activity seeks this index by time range, and the daily_totals
+        # backfill reads user_id and both times from it without touching
+        # the rows themselves
+        _conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_vs_start_end_user
+        ON voice_sessions (start_time, end_time, user_id)
+    """)
+        # Voice time per user and local day (YYYY-MM-DD), kept up to date on
+        # every insert so the daily stats never have to split sessions again
+        _conn.execute("""
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            user_id INTEGER,
+            day TEXT,
+            seconds INTEGER,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    """)
+        # !weekly reads every user's days in range, seeked on this index
+        # which also carries the seconds
+        _conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_dt_day
+        ON daily_totals (day, user_id, seconds)
+    """)
+        # Backfill the roll-up for databases created before it existed
+        if not _conn.execute("SELECT 1 FROM daily_totals LIMIT 1").fetchone():
+            _add_to_daily_totals(
+                _conn.execute("SELECT user_id, start_time, end_time FROM voice_sessions")
+            )
+    # gather planner statistics (ANALYZE) for tables that never had them,
+    # optimize_db() keeps them fresh afterwards
+    _conn.execute("PRAGMA optimize=0x10002")
+
+
+def close_db():
+    """Closes the shared connection."""
+    global _conn
+    if _conn is not None:
+        with _lock:
+            _conn.close()
+        _conn = None
+
+
+def optimize_db():
+    """Refreshes the planner statistics (ANALYZE) of the tables that changed."""
+    with _lock:
+        _conn.execute("PRAGMA optimize")
 
 
 def save_voice_session(
@@ -30,8 +113,8 @@ def save_voice_session(
     user_name: str,
     channel_id: int,
     channel_name: str,
-    start_time: datetime,
-    end_time: datetime,
+    start_time: float,
+    end_time: float,
 ):
     """
     Saves a voice session to the database.
@@ -41,28 +124,231 @@ def save_voice_session(
         user_name: Discord username
         channel_id: Voice channel ID
         channel_name: Voice channel name
-        start_time: Session start datetime
-        end_time: Session end datetime
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO voice_sessions (
-            user_id, user_name, channel_id, channel_name, start_time, end_time
-        ) VALUES (?, ?, ?, ?, ?, ?)
-        """,
+        start_time: Session start, unix timestamp
+        end_time: Session end, unix timestamp
+    """
+    # Same write path as the queued sessions, flushed right away
+    queue_voice_session(
+        user_id, user_name, channel_id, channel_name, start_time, end_time
+    )
+    flush_voice_sessions()
+
+
+def queue_voice_session(
+    user_id: int,
+    user_name: str,
+    channel_id: int,
+    channel_name: str,
+    start_time: float,
+    end_time: float,
+) -> int:
+    """
+    Queues a voice session to be saved by the next flush_voice_sessions().
+
+    Args:
+        user_id: Discord user ID
+        user_name: Discord username
+        channel_id: Voice channel ID
+        channel_name: Voice channel name
+        start_time: Session start, unix timestamp
+        end_time: Session end, unix timestamp
+
+    Returns:
+        number of sessions waiting to be flushed
+    """
+    row = (
+        user_id,
+        user_name,
+        channel_id,
+        channel_name,
+        int(start_time),
+        int(end_time),
+    )
+    with _pending_lock:
+        _pending.append(row)
+        return len(_pending)
+
+
+def pending_voice_sessions() -> int:
+    """Returns the number of sessions waiting for flush_voice_sessions()."""
+    return len(_pending)
+
+
+def flush_voice_sessions():
+    """Saves all queued voice sessions in a single transaction."""
+    global _pending
+    with _pending_lock:
+        rows, _pending = _pending, []
+    if not rows:
+        return
+
+    try:
+        with _lock, _conn:
+            _conn.executemany(_INSERT_SESSION_SQL, rows)
+            _add_to_daily_totals([(row[0], row[4], row[5]) for row in rows])
+    except Exception:
+        # the transaction was rolled back, put the sessions back for the next try
+        with _pending_lock:
+            _pending[:0] = rows
+        raise
+
+
+@contextmanager
+def _flushed_read():
+    """
+    Holds the shared connection for a read, the queued sessions are saved
+    first so they are part of the result.
+    """
+    flush_voice_sessions()
+    with _lock:
+        yield
+
+
+def _add_to_daily_totals(sessions):
+    """
+    Adds sessions to the daily_totals roll-up, split on local midnights.
+    Must run inside the transaction that saves the sessions.
+
+    Args:
+        sessions: Iterable of (user_id, start_time, end_time) unix timestamps
+    """
+    sessions = np.fromiter(
+        sessions, dtype=[("user", "i8"), ("start", "i8"), ("end", "i8")]
+    )
+    if not len(sessions):
+        return
+
+    from_date = datetime.fromtimestamp(sessions["start"].min())
+    to_date = datetime.fromtimestamp(sessions["end"].max())
+    user_ids, groups = np.unique(sessions["user"], return_inverse=True)
+    midnights = _local_midnights(from_date, to_date)
+    cells, seconds = _seconds_per_day(
+        sessions["start"], sessions["end"], groups, midnights
+    )
+
+    first_day = from_date.date()
+    users, days = np.divmod(cells, len(midnights) - 1)
+    _conn.executemany(
+        _ADD_DAILY_TOTAL_SQL,
+        (
+            (
+                user_ids[user].item(),
+                (first_day + timedelta(days=day)).isoformat(),
+                round(total),
+            )
+            for user, day, total in zip(
+                users.tolist(), days.tolist(), seconds.tolist()
+            )
+            if total
+        ),
+    )
+
+
+def _local_midnights(from_date: datetime, to_date: datetime):
+    """
+    Local midnights around every day in the range, as unix timestamps.
+    Element i is the start of day i, the last one ends the range.
+    """
+    first_day = from_date.date()
+    days = (to_date.date() - first_day).days + 1
+    return np.fromiter(
         (
-            user_id,
-            user_name,
-            channel_id,
-            channel_name,
-            int(start_time.timestamp()),
-            int(end_time.timestamp()),
+            datetime.combine(
+                first_day + timedelta(days=i), datetime.min.time()
+            ).timestamp()
+            for i in range(days + 1)
         ),
+        dtype=np.int64,
+        count=days + 1,
     )
-    conn.commit()
-    conn.close()
+
+
+def _seconds_per_day(starts, ends, groups, midnights):
+    """
+    Sums session time per group and day, splitting sessions on midnights.
+    Only the (group, day) cells with sessions are built, so memory grows
+    with the sessions and not with groups times days.
+
+    Args:
+        starts: array of session start timestamps
+        ends: array of session end timestamps
+        groups: array with the group index of every session
+        midnights: day boundaries from _local_midnights()
+
+    Returns:
+        (cells, seconds), sorted cell numbers (group * days + day) and the
+        seconds in each of them
+    """
+    days = len(midnights) - 1
+    start_day = np.searchsorted(midnights, starts, side="right") - 1
+    end_day = np.searchsorted(midnights, ends, side="right") - 1
+    first_cell = groups * days + start_day
+    multi_day = start_day != end_day
+
+    # Every session adds to the cell of its first day, the whole session
+    # when it ends the same day, otherwise the time up to midnight
+    cells = [first_cell]
+    weights = [np.where(multi_day, midnights[start_day + 1], ends) - starts]
+
+    # Nearly every session starts and ends on the same day, in that case
+    # there is nothing left to split
+    if multi_day.any():
+        # Sessions crossing midnight add their last partial day, and the
+        # full days in between as runs of cells. Runs are marked with +1
+        # where they start and -1 where they end, a sweep over the sorted
+        # marks gives how many sessions cover each stretch of cells
+        last_day = end_day[multi_day]
+        last_cell = first_cell[multi_day] - start_day[multi_day] + last_day
+        cells.append(last_cell)
+        weights.append(ends[multi_day] - midnights[last_day])
+
+        run_start = first_cell[multi_day] + 1
+        has_full_days = run_start < last_cell
+        marks, inverse = np.unique(
+            np.concatenate((run_start[has_full_days], last_cell[has_full_days])),
+            return_inverse=True,
+        )
+        ones = np.ones(has_full_days.sum())
+        coverage = np.cumsum(
+            np.bincount(inverse, weights=np.concatenate((ones, -ones)))
+        )[:-1]
+        covered = coverage > 0
+        lengths = np.diff(marks)[covered]
+        # every covered cell of the runs, in order
+        full_cells = np.arange(lengths.sum()) + np.repeat(
+            marks[:-1][covered] - np.cumsum(lengths) + lengths, lengths
+        )
+        cells.append(full_cells)
+        # a full day is the distance between two midnights (23h/25h on DST changes)
+        weights.append(
+            np.repeat(coverage[covered], lengths)
+            * np.diff(midnights)[full_cells % days]
+        )
+
+    cells, inverse = np.unique(np.concatenate(cells), return_inverse=True)
+    return cells, np.bincount(inverse, weights=np.concatenate(weights))
+
+
+def _days_in_range(from_date: datetime, to_date: datetime):
+    """Every date in the range, paired with its daily_totals key (YYYY-MM-DD)."""
+    first_day = from_date.date()
+    count = (to_date.date() - first_day).days + 1
+    days = (first_day + timedelta(days=i) for i in range(count))
+    return [(day, day.isoformat()) for day in days]
+
+
+def _to_daily_list(days, totals):
+    """
+    Zero pads daily_totals rows into a list covering the whole range.
+
+    Args:
+        days: Result of _days_in_range()
+        totals: defaultdict(int) of day (YYYY-MM-DD) -> seconds
+
+    Returns:
+        list of (date, timedelta)
+    """
+    return [(day, timedelta(seconds=totals[key])) for day, key in days]
 
 
 def get_daily_user_stats(user_id: int, from_date: datetime, to_date: datetime):
@@ -77,94 +363,110 @@ def get_daily_user_stats(user_id: int, from_date: datetime, to_date: datetime):
     Returns:
         list of (date, timedelta) for the user
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-
-    # Query to get sessions
-    c.execute(
-        """
-        SELECT start_time, end_time
-        FROM voice_sessions
-        WHERE user_id = ? AND start_time >= ? AND end_time <= ?
-        ORDER BY start_time
-    """,
-        (user_id, int(from_date.timestamp()), int(to_date.timestamp())),
-    )
-
-    results = c.fetchall()
-    conn.close()
-
-    # Create a list of (date, timedelta) for hours per day
     # time per day can go more than 24h if the underlying data is incorect (this is intended behavior)
-    time_per_date = defaultdict(timedelta)
-    for start_ts, end_ts in results:
-        start = datetime.fromtimestamp(start_ts)
-        end = datetime.fromtimestamp(end_ts)
-        if start.date() == end.date():
-            time_per_date[start.date()] += end - start
-        else:  # start and end are not in the same day
-            midnight = datetime.combine(
-                start.date() + timedelta(days=1), datetime.min.time()
-            )
-            time_per_date[start.date()] += midnight - start
-            # they maybe more than one day apart so this is safer than using previous midnight
-            midnight = datetime.combine(
-                end.date() - timedelta(days=1), datetime.max.time()
+    with _flushed_read():
+        totals = defaultdict(
+            int,
+            _conn.execute(
+                """
+                SELECT day, seconds
+                FROM daily_totals
+                WHERE user_id = ? AND day BETWEEN ? AND ?
+            """,
+                (user_id, from_date.date().isoformat(), to_date.date().isoformat()),
             )
-            time_per_date[start.date()] += end - midnight
-            # if they are more than one day apart
-            for i in range(1, (end - start).days):
-                time_per_date[start.date() + timedelta(days=i)] += timedelta(days=1)
+        )
+    return _to_daily_list(_days_in_range(from_date, to_date), totals)
 
-    # zero pad the missing days
-    date_cursor = from_date.date()
-    targetdate = to_date.date()
-    while date_cursor <= targetdate:
-        if not time_per_date[date_cursor]:
-            time_per_date[date_cursor] = timedelta(seconds=0)
-        date_cursor += timedelta(days=1)
 
-    return sorted(time_per_date.items())
+def get_all_users_daily_stats(from_date: datetime, to_date: datetime):
+    """
+    Retrieves daily aggregated voice time per day for every user with
+    activity in range, using a single query.
 
+    Args:
+        from_date: Filter in the date range
+        to_date: Filter in the date range
 
-def get_activity(from_date: datetime, to_date: datetime):
+    Returns:
+        dict of user_id -> list of (date, timedelta)
     """
-    Retrieves activity in range.
+    # rows are consumed straight from the cursor, no intermediate list
+    totals_per_user = defaultdict(lambda: defaultdict(int))
+    with _flushed_read():
+        cursor = _conn.execute(
+            """
+            SELECT user_id, day, seconds
+            FROM daily_totals
+            WHERE day BETWEEN ? AND ?
+        """,
+            (from_date.date().isoformat(), to_date.date().isoformat()),
+        )
+        for user_id, day, seconds in cursor:
+            totals_per_user[user_id][day] = seconds
+
+    # the same dates are shared by every user
+    days = _days_in_range(from_date, to_date)
+    return {
+        user_id: _to_daily_list(days, totals)
+        for user_id, totals in totals_per_user.items()
+    }
+
+
+def get_user_sessions_token(user_id: int, from_date: datetime, to_date: datetime):
+    """
+    Cheap fingerprint of the user's time in the range, changes whenever a
+    session adds time to it so it can be used as a cache key.
 
     Args:
+        user_id: Discord user ID
         from_date: Filter in the date range
         to_date: Filter in the date range
 
     Returns:
-        list of {user, channel, start, end}
+        (active day count, total seconds)
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-
-    # Query to get sessions
-    c.execute(
-        """
-        SELECT user_name, channel_name, start_time, end_time
-        FROM voice_sessions
-        WHERE start_time >= ? AND end_time <= ?
-        ORDER BY start_time
-    """,
-        (int(from_date.timestamp()), int(to_date.timestamp())),
-    )
+    # read from the roll-up, the cost grows with the days in range and not
+    # with the user's session history
+    with _flushed_read():
+        return _conn.execute(
+            """
+            SELECT COUNT(*), SUM(seconds)
+            FROM daily_totals
+            WHERE user_id = ? AND day BETWEEN ? AND ?
+        """,
+            (user_id, from_date.date().isoformat(), to_date.date().isoformat()),
+        ).fetchone()
+
 
-    results = c.fetchall()
-    conn.close()
+def get_activity(from_date: datetime, to_date: datetime):
+    """
+    Retrieves activity in range.
 
+    Args:
+        from_date: Filter in the date range
+        to_date: Filter in the date range
 
-    result = []
-    for user, channel, start_ts, end_ts in results:
-        result.append(
+    Returns:
+        list of {user, channel, start, end}
+    """
+    # Query to get sessions, rows are consumed straight from the cursor
+    with _flushed_read():
+        cursor = _conn.execute(
+            """
+            SELECT user_name, channel_name, start_time, end_time
+            FROM voice_sessions
+            WHERE start_time >= ? AND end_time <= ?
+            ORDER BY start_time
+        """,
+            (int(from_date.timestamp()), int(to_date.timestamp())),
+        )
+        return [
             {
                 "user": user,
                 "channel": channel,
                 "start": datetime.fromtimestamp(start_ts),
-                "end": datetime.fromtimestamp(end_ts)
+                "end": datetime.fromtimestamp(end_ts),
             }
-        )
-
-    return result
+            for user, channel, start_ts, end_ts in cursor
+        ]
@@ -1,10 +1,51 @@
 import io
+import math
+import threading
+from collections import defaultdict
+from functools import lru_cache
 
-import matplotlib.pyplot as plt
+import matplotlib
+
+# Render straight to image buffers, no GUI backend
+matplotlib.use("Agg")
+# Pin the (bundled) font so text layout resolves a single family
+matplotlib.rcParams.update({"font.family": "DejaVu Sans", "font.size": 10})
+
+import matplotlib.dates as mdates
 import numpy as np
-import pandas as pd
-import plotly.express as px
-# from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
+from PIL import Image, ImageDraw, ImageFont
+
+# Discord scales previews down anyway, so render at screen resolution and
+# favour encoding speed over file size
+DPI = 100
+PNG_OPTIONS = {"compress_level": 1}
+
+# Figures are built once and cleared between renders instead of being
+# recreated for every command, each lock guards one figure
+_DAILY_FIG = Figure(figsize=(10, 5))
+_DAILY_AX = _DAILY_FIG.subplots()
+# Fixed margins, measuring them with tight_layout costs an extra render pass
+_DAILY_FIG.subplots_adjust(left=0.08, right=0.98, top=0.92, bottom=0.16)
+_DAILY_LOCK = threading.Lock()
+
+_GROUPED_FIG = Figure(figsize=(10, 6))
+_GROUPED_AX = _GROUPED_FIG.subplots()
+_GROUPED_FIG.subplots_adjust(left=0.08, right=0.98, top=0.93, bottom=0.14)
+_GROUPED_LOCK = threading.Lock()
+
+_TIMELINE_FIG = Figure(figsize=(10, 5))
+_TIMELINE_AX = _TIMELINE_FIG.subplots()
+# room on the right for the channel legend
+_TIMELINE_FIG.subplots_adjust(left=0.12, right=0.8, top=0.92, bottom=0.1)
+_TIMELINE_LOCK = threading.Lock()
+
+# Draw every figure once at startup so font lookup and the Agg renderer are
+# ready before the first command instead of slowing it down
+for _fig in (_DAILY_FIG, _GROUPED_FIG, _TIMELINE_FIG):
+    FigureCanvasAgg(_fig).draw()
 
 
 def create_activity_per_day_graph(daily_data):
@@ -20,44 +61,139 @@ def create_activity_per_day_graph(daily_data):
     if not daily_data:
         return None
 
-    # Convert data to lists
-    dates, hours = zip(
-        *[
-            (date.strftime("%a\n%m/%d"), (total.total_seconds() / 3600))
-            for date, total in daily_data
-        ]
+    # Convert data to bar labels and heights
+    dates = [date.strftime("%a\n%m/%d") for date, _ in daily_data]
+    hours = np.fromiter(
+        (total.total_seconds() for _, total in daily_data),
+        dtype=np.float64,
+        count=len(daily_data),
     )
+    hours /= 3600
 
-    # Create bar chart
-    fig, ax = plt.subplots(figsize=(10, 5))
-    bars = ax.bar(dates, hours, color="#5865F2")
-
-    # Labels and title
-    ax.set_xlabel("Date")
-    ax.set_ylabel("Hours")
-    ax.set_title("User voice chat activity per day")
-    ax.grid(axis="y", alpha=0.3)
-
-    # Add value labels on bars
-    for bar in bars:
-        height = bar.get_height()
-        if height > 0:
-            ax.text(
-                bar.get_x() + bar.get_width() / 2,
-                height,
-                f"{int(height)}h {int((height - int(height)) * 60)}m",
-                ha="center",
-                va="bottom",
-            )
+    buf = io.BytesIO()
+    with _DAILY_LOCK:
+        fig, ax = _DAILY_FIG, _DAILY_AX
+        ax.clear()
+
+        # Create bar chart
+        bars = ax.bar(dates, hours, color="#5865F2")
+
+        # Labels and title
+        ax.set_xlabel("Date")
+        ax.set_ylabel("Hours")
+        ax.set_title("User voice chat activity per day")
+        ax.grid(axis="y", alpha=0.3)
+
+        # Add value labels on bars
+        ax.bar_label(
+            bars,
+            labels=[
+                f"{int(h)}h {int((h - int(h)) * 60)}m" if h > 0 else ""
+                for h in hours.tolist()
+            ],
+        )
+
+        ax.tick_params(axis="x", labelrotation=0)
+
+        # Save to buffer
+        fig.savefig(buf, format="png", dpi=DPI, pil_kwargs=PNG_OPTIONS)
+    buf.seek(0)
+
+    return buf
+
+
+@lru_cache(maxsize=None)
+def _pil_font(size):
+    """Loads a font once per size, falls back to Pillow's bundled font."""
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def create_activity_per_day_graph_pil(daily_data):
+    """
+    Creates the same bar graph as create_activity_per_day_graph, drawn
+    directly with Pillow instead of going through matplotlib.
+
+    Args:
+        daily_data: Iterable of (date, timedelta) tuples
+
+    Returns:
+        BytesIO object containing the PNG image, or None if no data
+    """
+    if not daily_data:
+        return None
+
+    width, height = 1000, 500
+    left, right, top, bottom = 90, 980, 40, 420
+    font = _pil_font(14)
+    title_font = _pil_font(18)
 
-    plt.xticks(rotation=0)
-    plt.tight_layout()
+    hours = [total.total_seconds() / 3600 for _, total in daily_data]
+
+    # Pick a 1/2/5 step giving at most ~6 grid lines
+    max_hours = max(max(hours), 1)
+    magnitude = 10 ** math.floor(math.log10(max_hours / 6))
+    step = next(
+        m * magnitude for m in (1, 2, 5, 10) if max_hours / (m * magnitude) <= 6
+    )
+    y_max = math.ceil(max_hours * 1.05 / step) * step
+    scale = (bottom - top) / y_max
+
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+
+    # Title and axis labels
+    center = (left + right) / 2
+    draw.text(
+        (center, 20),
+        "User voice chat activity per day",
+        fill="black",
+        font=title_font,
+        anchor="mm",
+    )
+    draw.text((center, height - 20), "Date", fill="black", font=font, anchor="mm")
+    draw.text((30, (top + bottom) / 2), "Hours", fill="black", font=font, anchor="mm")
+
+    # Grid lines with their y tick labels
+    tick = 0
+    while tick <= y_max:
+        y = bottom - tick * scale
+        draw.line((left, y, right, y), fill="#e5e5e5")
+        draw.text((left - 8, y), f"{tick:g}", fill="black", font=font, anchor="rm")
+        tick += step
+    draw.rectangle((left, top, right, bottom), outline="black")
+
+    # Bars, value labels and date labels
+    slot = (right - left) / len(daily_data)
+    bar_width = slot * 0.8
+    for i, ((date, _), value) in enumerate(zip(daily_data, hours)):
+        x = left + slot * i + slot / 2
+        if value > 0:
+            y = bottom - value * scale
+            draw.rectangle(
+                (x - bar_width / 2, y, x + bar_width / 2, bottom), fill="#5865F2"
+            )
+            draw.text(
+                (x, y - 2),
+                f"{int(value)}h {int((value - int(value)) * 60)}m",
+                fill="black",
+                font=font,
+                anchor="md",
+            )
+        draw.multiline_text(
+            (x, bottom + 8),
+            date.strftime("%a\n%m/%d"),
+            fill="black",
+            font=font,
+            anchor="ma",
+            align="center",
+        )
 
-    # Save to buffer
     buf = io.BytesIO()
-    plt.savefig(buf, format="png", dpi=250)
+    img.save(buf, format="PNG", **PNG_OPTIONS)
     buf.seek(0)
-    plt.close(fig)
 
     return buf
 
@@ -82,69 +218,95 @@ def create_grouped_bar_chart(dates, user_data):
     num_users = len(user_data)
     x = np.arange(len(dates))
     width = 0.8 / num_users
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-
-    for i, (username, hours) in enumerate(user_data.items()):
-        offset = width * (i - num_users / 2 + 0.5)
-        ax.bar(x + offset, hours, width, label=username)
-
-    ax.set_xlabel("Date")
-    ax.set_ylabel("Hours")
-    ax.set_title("User Activity")
-    ax.set_xticks(x)
-    ax.set_xticklabels(dates, rotation=0)
-    ax.legend()
-    ax.grid(axis="y", alpha=0.3)
-
-    plt.tight_layout()
+    # bar positions and heights for every user at once, shaped (users, dates)
+    offsets = width * (np.arange(num_users) - num_users / 2 + 0.5)
+    positions = x + offsets[:, None]
+    hours = np.asarray(list(user_data.values()), dtype=np.float64)
 
     buf = io.BytesIO()
-    plt.savefig(buf, format="png", dpi=250)
+    with _GROUPED_LOCK:
+        fig, ax = _GROUPED_FIG, _GROUPED_AX
+        ax.clear()
+
+        # one bar() per user, each needs its own color and legend entry
+        for username, position, height in zip(user_data, positions, hours):
+            ax.bar(position, height, width, label=username)
+
+        ax.set_xlabel("Date")
+        ax.set_ylabel("Hours")
+        ax.set_title("User Activity")
+        ax.set_xticks(x)
+        ax.set_xticklabels(dates, rotation=0)
+        ax.legend()
+        ax.grid(axis="y", alpha=0.3)
+
+        fig.savefig(buf, format="png", dpi=DPI, pil_kwargs=PNG_OPTIONS)
     buf.seek(0)
-    plt.close(fig)
 
     return buf
 
 
 def create_daily_activity(data):
+    """
+    Creates a timeline of the voice sessions of a day, one row per user and
+    one color per channel.
 
-    df = pd.DataFrame(data)
-
-    # 1. Assign a dummy date to the time strings so Plotly can parse them as datetime objects
-    # dummy_date = "2024-01-01 "
-    # df["Start"] = pd.to_datetime(dummy_date + df["Start"])
-    # df["End"] = pd.to_datetime(dummy_date + df["End"])
-
-    # 2. Create the timeline
-    fig = px.timeline(
-        df,
-        x_start="start",
-        x_end="end",
-        y="user",
-        color="channel",
-        title="User Activity 24-Hour View (Amsterdam Time)",
-    )
+    Args:
+        data: List of {user, channel, start, end} dicts (see get_activity)
 
-    # 3. Format the X-axis to show ONLY time
-    fig.update_xaxes(
-        tickformat="%H",
-        # Optional: Force the range to be the full 24 hours
-        # range=[dummy_date + "00:00:00", dummy_date + "23:59:59"],
-        dtick=3600000 * 1,  # Show a tick every 2 hours (ms * seconds * hours)
-    )
-    fig.update_yaxes(autorange="reversed")  # Traditional Gantt view (top to bottom)
+    Returns:
+        BytesIO object containing the PNG image, or None if no data
+    """
+    if not data:
+        return None
+
+    # Rows in order of first activity, top to bottom
+    users = list(dict.fromkeys(session["user"] for session in data))
+    channels = list(dict.fromkeys(session["channel"] for session in data))
+    colors = matplotlib.colormaps["tab10"]
 
     buf = io.BytesIO()
-    # 3. Write the image to the buffer
-    #    - file: accepts the buffer object
-    #    - format: 'png', 'jpeg', 'svg', or 'pdf'
-    #    - scale: equivalent to increasing DPI (default is 1, 2-3 is usually high res)
-    fig.write_image(buf, format="png", width=800, height=400, scale=2)
-    buf.seek(0)
+    with _TIMELINE_LOCK:
+        fig, ax = _TIMELINE_FIG, _TIMELINE_AX
+        ax.clear()
+
+        # One broken_barh call per (user, channel) draws all their sessions
+        bars = defaultdict(list)
+        for session in data:
+            start = mdates.date2num(session["start"])
+            end = mdates.date2num(session["end"])
+            bars[session["user"], session["channel"]].append((start, end - start))
+        for (user, channel), spans in bars.items():
+            ax.broken_barh(
+                spans,
+                (users.index(user) - 0.4, 0.8),
+                facecolors=colors(channels.index(channel) % colors.N),
+            )
 
-    # img = Image.open(buf)
-    # img.show()
-    # fig.show()
+        ax.set_yticks(range(len(users)))
+        ax.set_yticklabels(users)
+        ax.invert_yaxis()  # Traditional Gantt view (top to bottom)
+        ax.set_title("User Activity 24-Hour View (Amsterdam Time)")
+        ax.set_xlabel("Hour")
+        ax.grid(axis="x", alpha=0.3)
+        ax.set_axisbelow(True)
+
+        # Format the X-axis to show ONLY the hour, one tick per hour
+        ax.xaxis_date()
+        ax.xaxis.set_major_locator(mdates.HourLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter("%H"))
+
+        ax.legend(
+            handles=[
+                Patch(color=colors(i % colors.N), label=channel)
+                for i, channel in enumerate(channels)
+            ],
+            title="channel",
+            loc="upper left",
+            bbox_to_anchor=(1.01, 1),
+        )
+
+        fig.savefig(buf, format="png", dpi=DPI, pil_kwargs=PNG_OPTIONS)
+    buf.seek(0)
 
     return buf
@@ -0,0 +1,98 @@
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import database
+
+
+@pytest.fixture
+def dst_timezone(monkeypatch):
+    # Europe/Berlin has a 23h day on 2026-03-29 and a 25h day on 2026-10-25
+    monkeypatch.setenv("TZ", "Europe/Berlin")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def naive_seconds_per_day(sessions):
+    """Splits every session one local midnight at a time."""
+    totals = defaultdict(int)
+    for group, start, end in sessions:
+        current = start
+        while current < end:
+            day = datetime.fromtimestamp(current).date()
+            midnight = datetime.combine(
+                day + timedelta(days=1), datetime.min.time()
+            ).timestamp()
+            totals[group, day] += min(end, midnight) - current
+            current = midnight
+    return {key: seconds for key, seconds in totals.items() if seconds}
+
+
+def random_sessions(count, first_day, last_day):
+    """Sessions of up to a few days, some starting or ending on a midnight."""
+    rng = random.Random(42)
+    first = int(datetime.combine(first_day, datetime.min.time()).timestamp())
+    last = int(datetime.combine(last_day, datetime.min.time()).timestamp())
+    sessions = []
+    for _ in range(count):
+        start = rng.randrange(first, last)
+        end = start + rng.choice([3, 600, 3 * 3600, 20 * 3600, 50 * 3600, 200 * 3600])
+        sessions.append((rng.randrange(5), start, end))
+    for day in (first_day + timedelta(days=i) for i in range(3)):
+        midnight = int(datetime.combine(day, datetime.min.time()).timestamp())
+        sessions.append((rng.randrange(5), midnight, midnight + 90000))
+        sessions.append((rng.randrange(5), midnight - 4000, midnight))
+    return sessions
+
+
+@pytest.mark.parametrize(
+    "first_day",
+    [datetime(2026, 3, 25).date(), datetime(2026, 10, 21).date()],
+)
+def test_seconds_per_day_matches_naive_split(dst_timezone, first_day):
+    sessions = random_sessions(2000, first_day, first_day + timedelta(days=10))
+    groups, starts, ends = (np.array(column) for column in zip(*sessions))
+    from_date = datetime.fromtimestamp(starts.min())
+    midnights = database._local_midnights(
+        from_date, datetime.fromtimestamp(ends.max())
+    )
+
+    cells, seconds = database._seconds_per_day(starts, ends, groups, midnights)
+
+    days = len(midnights) - 1
+    result = {
+        (cell // days, from_date.date() + timedelta(days=cell % days)): total
+        for cell, total in zip(cells.tolist(), seconds.tolist())
+        if total
+    }
+    assert result == naive_seconds_per_day(sessions)
+
+
+def test_flushed_sessions_reach_daily_stats(dst_timezone, tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_PATH", str(tmp_path / "stats.db"))
+    database.init_db()
+    try:
+        first_day = datetime(2026, 10, 21).date()
+        sessions = random_sessions(300, first_day, first_day + timedelta(days=10))
+        for user_id, start, end in sessions:
+            database.queue_voice_session(user_id, "user", 1, "voice", start, end)
+
+        from_date = datetime.combine(first_day - timedelta(days=1), datetime.min.time())
+        to_date = from_date + timedelta(days=21)
+        expected = naive_seconds_per_day(sessions)
+        for user_id in range(5):
+            assert {
+                day: delta.total_seconds()
+                for day, delta in database.get_daily_user_stats(
+                    user_id, from_date, to_date
+                )
+                if delta
+            } == {day: seconds for (user, day), seconds in expected.items() if user == user_id}
+    finally:
+        database.close_db()